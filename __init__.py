@@ -1,21 +1,77 @@
 import logging
 import asyncio
 import base64
+import contextlib
+import functools
+import json
 import urllib.parse
 
 import aiohttp
 import opsdroid.events
 from opsdroid.connector import Connector, register_event
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-logger = logging.getLogger(__name__)
 
+logger = logging.getLogger(__name__)
 
+# Use orjson for decoding and encoding if it's installed.
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+else:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+SEND_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5)
+MAX_CONCURRENT_PARSE = 32
+# signal-cli's receive timeout is an idle timeout: a poll returns once no
+# message has arrived for RECEIVE_TIMEOUT seconds, or after
+# RECEIVE_MAX_MESSAGES messages.
+RECEIVE_TIMEOUT = 5
+RECEIVE_MAX_MESSAGES = 10
+# Files can be large, only time out if the transfer stalls.
+FILE_TIMEOUT = aiohttp.ClientTimeout(connect=5, sock_read=30)
+FILE_CHUNK_SIZE = 65536
+
+# Event classes for received attachments, by the first part of the mimetype.
+ATTACHMENT_CLASSES = {
+    "image": opsdroid.events.Image,
+    "video": opsdroid.events.Video,
+}
+DEFAULT_ATTACHMENT_CLASS = opsdroid.events.File
+
+
+async def stream_base64(head, stream, tail):
+    """Yield head, then the contents of stream encoded with base64, then tail."""
+    yield head
+    rest = b""
+    async for chunk in stream.iter_chunked(FILE_CHUNK_SIZE):
+        chunk = rest + chunk
+        # Only encode whole 3-byte groups so no padding ends up mid-stream.
+        cut = len(chunk) - len(chunk) % 3
+        rest = chunk[cut:]
+        yield base64.b64encode(chunk[:cut])
+    yield base64.b64encode(rest) + tail
+
+
+@functools.lru_cache(maxsize=512)
 def encode_group_id(group_id):
     """Encode group_id as returned by the websocket for use with other endpoints."""
     return "group." + base64.b64encode(group_id.encode("ascii")).decode("ascii")
 
 
+class _ParseContext:
+    """Fields shared by all events created from one received packet."""
+
+    __slots__ = ("user_id", "user", "connector", "raw_event", "event_id", "target")
+
+
 class ConnectorSignal(Connector):
     """A connector for the Signal chat service."""
 
@@ -36,14 +92,27 @@ class ConnectorSignal(Connector):
 
         self.inv_rooms = {v: k for k, v in self.rooms.items()}
         self.session = None
+        self.keepalive_timeout = config.get("keepalive-timeout", 75)
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.parse_semaphore = asyncio.Semaphore(MAX_CONCURRENT_PARSE)
+
+        # The endpoints don't change, build them once.
+        self._base = self.parsed_url._replace(path="", params="", query="",
+                                              fragment="").geturl()
+        self._url_about = self.make_url("/v1/about")
+        self._url_receive = self.make_url("/v1/receive/{bot_number}")
+        self._url_send = self.make_url("/v2/send")
+        self._url_typing = self.make_url("/v1/typing-indicator/{bot_number}")
+        self._url_reactions = self.make_url("/v1/reactions/{bot_number}")
 
     def make_url(self, path_format):
-        """Build the url to connect with the REST API.
+        """Build the path to connect with the REST API.
         Occurrences of {bot_number} in path_format are replaced with
         the configured phone number that the Signal client is using.
+        The host part is supplied by the session's base_url.
         """
-        path = path_format.format(bot_number=urllib.parse.quote(self.bot_number))
-        return self.parsed_url._replace(path=path).geturl()
+        return path_format.format(bot_number=urllib.parse.quote(self.bot_number))
 
     def lookup_target(self, target):
         """Convert room alias into Signal phone number or group ID.
@@ -53,9 +122,40 @@ class ConnectorSignal(Connector):
 
     async def connect(self):
         """Connect to the chat service.
-        In this case we just create a http session.
+        In this case we just create a http session whose connection
+        pool is reused by all requests to the REST API.
         """
-        self.session = aiohttp.ClientSession(raise_for_status=True)
+        connector = aiohttp.TCPConnector(limit=100,
+                                         limit_per_host=20,
+                                         force_close=False,
+                                         keepalive_timeout=self.keepalive_timeout,
+                                         enable_cleanup_closed=True,
+                                         ttl_dns_cache=300)
+        # No total timeout here, the websocket in listen() is long-lived.
+        # Other requests pass SEND_TIMEOUT or their own timeout instead.
+        timeout = aiohttp.ClientTimeout(connect=5)
+        trace_config = self.make_trace_config()
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             raise_for_status=False,
+                                             base_url=self._base,
+                                             json_serialize=json_dumps,
+                                             timeout=timeout,
+                                             trace_configs=[trace_config])
+
+    def make_trace_config(self):
+        """Count how often pooled connections are reused."""
+        async def on_reuse(session, ctx, params):
+            self.connections_reused += 1
+            logger.debug("reused pooled connection")
+
+        async def on_create(session, ctx, params):
+            self.connections_created += 1
+            logger.debug("opened new connection")
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        trace_config.on_connection_create_end.append(on_create)
+        return trace_config
 
     async def disconnect(self):
         """Disconnect from the chat service."""
@@ -64,171 +164,318 @@ class ConnectorSignal(Connector):
 
     async def listen(self):
         """Listen for and parse new messages."""
-        async with self.session.get(self.make_url("/v1/about")) as resp:
-            about = await resp.json()
+        async with self.session.get(self._url_about, timeout=SEND_TIMEOUT) as resp:
+            resp.raise_for_status()
+            about = json_loads(await resp.read())
         logger.debug("about signal-cli-rest-api %s", about)
 
-        url = self.make_url("/v1/receive/{bot_number}")
+        # Make sure the connection was kept alive.  If the server (or a proxy
+        # in front of it) closes it, every request pays for a new handshake.
+        created = self.connections_created
+        async with self.session.get(self._url_about, timeout=SEND_TIMEOUT) as resp:
+            await resp.read()
+        if self.connections_created > created:
+            logger.warning("signal-cli-rest-api does not keep connections alive")
+        else:
+            logger.debug("signal-cli-rest-api keeps connections alive")
+
+        url = self._url_receive
         if about.get("mode") == "json-rpc":
-            async with self.session.ws_connect(url) as ws:
-                async for msg in ws:
-                    if msg.type == aiohttp.WSMsgType.TEXT:
-                        await self.parse_packet(msg.json())
+            # Parse packets in tasks so that slow skills don't hold up
+            # reading from the websocket.
+            pending = set()
+            try:
+                async with self.session.ws_connect(url) as ws:
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            packet = json_loads(msg.data)
+                            task = asyncio.create_task(self.parse_packet(packet))
+                            pending.add(task)
+                            task.add_done_callback(pending.discard)
+            except asyncio.CancelledError:
+                # Don't hold up disconnect() waiting for skills to finish,
+                # the session is about to be closed under them anyway.
+                for task in pending:
+                    task.cancel()
+                raise
+            finally:
+                await asyncio.gather(*pending, return_exceptions=True)
         else:
+            # Each poll waits a short while for messages, so there's no need
+            # to sleep between requests unless something goes wrong.
             interval = self.config.get("poll-interval", 10)
+            params = {"timeout": RECEIVE_TIMEOUT,
+                      "max_messages": RECEIVE_MAX_MESSAGES}
+            # A response can hold messages the server has already acknowledged,
+            # so don't abort it before the server can possibly be done.
+            read_timeout = RECEIVE_TIMEOUT * RECEIVE_MAX_MESSAGES + 10
+            timeout = aiohttp.ClientTimeout(connect=5, sock_read=read_timeout)
             while True:
-                async with self.session.get(url) as resp:
-                    packets = await resp.json(content_type=None)
+                try:
+                    async with self.session.get(url, params=params,
+                                                timeout=timeout) as resp:
+                        if resp.status >= 400:
+                            logger.warning("receive failed: signal API %s: %s",
+                                           resp.status, await resp.text())
+                            packets = None
+                        else:
+                            packets = json_loads(await resp.read())
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    logger.warning("receive failed: %s", error)
+                    packets = None
+                if packets is None:
+                    await asyncio.sleep(interval)
+                    continue
                 for packet in packets:
                     await self.parse_packet(packet)
-                await asyncio.sleep(interval)
 
     async def parse_packet(self, packet):
-        logger.debug("parse packet %s", packet)
+        async with self.parse_semaphore:
+            try:
+                await self._parse_packet(packet)
+            except Exception:
+                logger.exception("failed to parse packet")
+
+    async def _parse_packet(self, packet):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("parse packet %s", packet)
+        envelope = packet.get("envelope")
+        if envelope is None:
+            logger.debug("missing 'envelope' key")
+            return
         try:
-            envelope = packet["envelope"]
-            args = dict(user_id=envelope["sourceNumber"],
-                        user=envelope["sourceName"],
-                        connector=self,
-                        raw_event=packet,
-                        event_id=envelope["timestamp"])
+            user_id = envelope["sourceNumber"]
+            event_id = envelope["timestamp"]
         except KeyError as error:
             logger.debug("missing '%s' key", error.args[0])
             return
 
-        if self.whitelist and args["user_id"] not in self.whitelist:
-            logger.debug("user '%s' not whitelisted", args["user_id"])
+        # Drop packets from other users before doing any more work.
+        if self.whitelist and user_id not in self.whitelist:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("user '%s' not whitelisted", user_id)
             return
 
+        ctx = _ParseContext()
+        ctx.user_id = user_id
+        ctx.event_id = event_id
+        ctx.user = envelope.get("sourceName")
+        ctx.connector = self
+        ctx.raw_event = packet
+        ctx.target = None
+
         data_message = envelope.get("dataMessage")
         if data_message:
-            await self.parse_data_message(data_message, args)
+            await self.parse_data_message(data_message, ctx)
 
         typing_message = envelope.get("typingMessage")
         if typing_message:
-            await self.parse_typing_message(typing_message, args)
+            await self.parse_typing_message(typing_message, ctx)
 
-    async def parse_data_message(self, data_message, args):
-        try:
-            target = encode_group_id(data_message["groupInfo"]["groupId"])
-        except KeyError:
-            target = args["user_id"]
-        args["target"] = self.inv_rooms.get(target, target)
+    async def parse_data_message(self, data_message, ctx):
+        group_info = data_message.get("groupInfo")
+        group_id = group_info.get("groupId") if group_info else None
+        target = encode_group_id(group_id) if group_id else ctx.user_id
+        ctx.target = self.inv_rooms.get(target, target)
 
         text = data_message.get("message")
         reaction = data_message.get("reaction")
         if reaction:
-            await self.parse_reaction(reaction, args)
+            await self.parse_reaction(reaction, ctx)
         elif text:
-            await self.parse_text(text, args)
+            await self.parse_text(text, ctx)
 
+        # parse_attachment() only reads ctx, so the attachments
+        # can be parsed concurrently.
         attachments = data_message.get("attachments")
-        for attachment in (attachments or ()):
-            await self.parse_attachment(attachment, args)
+        if attachments:
+            await asyncio.gather(*(self.parse_attachment(attachment, ctx)
+                                   for attachment in attachments))
 
-    async def parse_reaction(self, reaction, args):
+    async def parse_reaction(self, reaction, ctx):
         emoji = ("" if reaction.get("isRemove") else reaction["emoji"])
         linked = opsdroid.events.Event(user_id=reaction["targetAuthorNumber"],
-                                       target=args["target"],
-                                       connector=args["connector"],
+                                       target=ctx.target,
+                                       connector=ctx.connector,
                                        event_id=reaction["targetSentTimestamp"])
-        event = opsdroid.events.Reaction(emoji=emoji, linked_event=linked, **args)
-        logger.info("received reaction %s from %s", event, event.target)
+        event = opsdroid.events.Reaction(emoji=emoji,
+                                         linked_event=linked,
+                                         user_id=ctx.user_id,
+                                         user=ctx.user,
+                                         target=ctx.target,
+                                         connector=ctx.connector,
+                                         raw_event=ctx.raw_event,
+                                         event_id=ctx.event_id)
+        logger.info("received reaction id=%s from %s", event.event_id, event.target)
         await self.opsdroid.parse(event)
 
-    async def parse_text(self, text, args):
-        event = opsdroid.events.Message(text=text, **args)
-        logger.info("received message %s from %s", event, event.target)
+    async def parse_text(self, text, ctx):
+        event = opsdroid.events.Message(text=text,
+                                        user_id=ctx.user_id,
+                                        user=ctx.user,
+                                        target=ctx.target,
+                                        connector=ctx.connector,
+                                        raw_event=ctx.raw_event,
+                                        event_id=ctx.event_id)
+        logger.info("received message id=%s from %s", event.event_id, event.target)
         await self.opsdroid.parse(event)
 
-    async def parse_attachment(self, attachment, args):
-        url = self.make_url(f"v1/attachments/{attachment['id']}")
+    async def parse_attachment(self, attachment, ctx):
+        url = f"{self._base}/v1/attachments/{attachment['id']}"
         name = attachment.get("filename")
         mimetype = attachment.get("contentType")
-        file_type = (mimetype or "").split("/")[0]
-
-        event_class = {
-            "image": opsdroid.events.Image,
-            "video": opsdroid.events.Video,
-        }.get(file_type, opsdroid.events.File)
+        file_type = mimetype.partition("/")[0] if mimetype else ""
+        event_class = ATTACHMENT_CLASSES.get(file_type, DEFAULT_ATTACHMENT_CLASS)
 
         event = event_class(url=url,
                             name=name,
                             mimetype=mimetype,
-                            **args)
-        logger.info("received file %s from %s", event, event.target)
+                            user_id=ctx.user_id,
+                            user=ctx.user,
+                            target=ctx.target,
+                            connector=ctx.connector,
+                            raw_event=ctx.raw_event,
+                            event_id=ctx.event_id)
+        logger.info("received file id=%s from %s", event.event_id, event.target)
         await self.opsdroid.parse(event)
 
-    async def parse_typing_message(self, typing_message, args):
-        try:
-            target = encode_group_id(typing_message["groupId"])
-        except KeyError:
-            target = args["user_id"]
-        args["target"] = self.inv_rooms.get(target, target)
+    async def parse_typing_message(self, typing_message, ctx):
+        group_id = typing_message.get("groupId")
+        target = encode_group_id(group_id) if group_id else ctx.user_id
+        target = self.inv_rooms.get(target, target)
 
         trigger = (typing_message.get("action") == "STARTED")
-        user_id = args.pop("user_id")
         event = opsdroid.events.Typing(trigger=trigger,
                                        timeout=15,
-                                       **args)
-        event.user_id = user_id  # here before pr#1877 lands
-        logger.info("received typing %s from %s", event, event.target)
+                                       user=ctx.user,
+                                       target=target,
+                                       connector=ctx.connector,
+                                       raw_event=ctx.raw_event,
+                                       event_id=ctx.event_id)
+        event.user_id = ctx.user_id  # here before pr#1877 lands
+        logger.info("received typing id=%s from %s", event.event_id, event.target)
         await self.opsdroid.parse(event)
 
     def get_recipients_from_event(self, event):
         """Get Signal recipients from an opsdroid Event object."""
-        return [x for x in (self.lookup_target(event.target),) if x]
+        target = self.rooms.get(event.target, event.target)
+        return [target] if target else []
 
     @register_event(opsdroid.events.Message)
     async def send_message(self, event):
         """Send a text message."""
-        logger.info("send message %s to %s", event, event.target)
+        logger.info("send message id=%s to %s", event.event_id, event.target)
         data = {
             "number": self.bot_number,
             "recipients": self.get_recipients_from_event(event),
             "message": event.text,
         }
-        async with self.session.post(self.make_url("/v2/send"), json=data) as resp:
-            result = await resp.json()
-        logger.debug("result %s", result)
+        async with self.session.post(self._url_send, json=data,
+                                     timeout=SEND_TIMEOUT) as resp:
+            if resp.status >= 400:
+                logger.warning("signal API %s: %s", resp.status, await resp.text())
+                return
+            # The result is only logged, don't parse it otherwise.  The body
+            # is still read so the connection goes back to the pool.
+            body = await resp.read()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("result %s", json_loads(body))
 
     @register_event(opsdroid.events.File, include_subclasses=True)
     async def send_file(self, event):
         """Send a file/image/video message."""
-        logger.info("send file %s to %s", event, event.target)
-        file_bytes = await event.get_file_bytes()
+        logger.info("send file id=%s to %s", event.event_id, event.target)
         data = {
             "number": self.bot_number,
             "recipients": self.get_recipients_from_event(event),
-            "base64_attachments": [
-                base64.b64encode(file_bytes).decode("ascii"),
-            ],
         }
-        async with self.session.post(self.make_url("/v2/send"), json=data) as resp:
-            result = await resp.json()
-        logger.debug("result %s", result)
+        # /v2/send only takes JSON.  Splice the base64 attachment into
+        # the body by hand so it isn't copied again by the JSON encoder.
+        # Base64 output never needs escaping.
+        head = json_dumps(data)[:-1].encode("utf-8") + b', "base64_attachments": ["'
+        tail = b'"]}'
+        url = event.url
+        # Same rule as File.get_file_bytes(): bytes given or already
+        # fetched take precedence over the url.  _file_bytes and
+        # _url_headers are opsdroid internals, read the way
+        # get_file_bytes() reads them.
+        if (not event._file_bytes and url
+                and url.startswith(("http://", "https://"))):
+            # Stream the file from its source, encoding it on the way,
+            # so it's never held in memory as a whole.
+            async with self.fetch_url(url, event._url_headers) as src:
+                if src.status >= 400:
+                    logger.warning("fetching %s failed: %s", url, src.status)
+                    return
+                await self.post_file(stream_base64(head, src.content, tail))
+        else:
+            file_bytes = await event.get_file_bytes()
+            attachment = base64.b64encode(file_bytes)
+            del file_bytes
+            payload = b"".join((head, attachment, tail))
+            del attachment
+            await self.post_file(payload)
+
+    @contextlib.asynccontextmanager
+    async def fetch_url(self, url, headers=None):
+        """Make a GET request for a file to be sent.
+        Files served by signal-cli-rest-api reuse the session's connection
+        pool, other URLs go through a one-off session which, like
+        File.get_file_bytes(), honours proxy settings from the environment.
+        """
+        if url.startswith(self._base + "/"):
+            async with self.session.get(url[len(self._base):], headers=headers,
+                                        timeout=FILE_TIMEOUT) as resp:
+                yield resp
+        else:
+            async with aiohttp.ClientSession(trust_env=True,
+                                             timeout=FILE_TIMEOUT) as session:
+                async with session.get(url, headers=headers) as resp:
+                    yield resp
+
+    async def post_file(self, payload):
+        """Post a JSON body built by send_file."""
+        headers = {"Content-Type": "application/json"}
+        async with self.session.post(self._url_send, data=payload, headers=headers,
+                                     timeout=FILE_TIMEOUT) as resp:
+            if resp.status >= 400:
+                logger.warning("signal API %s: %s", resp.status, await resp.text())
+                return
+            # The result is only logged, don't parse it otherwise.  The body
+            # is still read so the connection goes back to the pool.
+            body = await resp.read()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("result %s", json_loads(body))
 
     @register_event(opsdroid.events.Typing)
     async def send_typing(self, event):
         """Set or remove the typing indicator."""
-        logger.info("send typing %s to %s", event, event.target)
+        logger.info("send typing id=%s to %s", event.event_id, event.target)
         method = (self.session.put if event.trigger else self.session.delete)
-        url = self.make_url("/v1/typing-indicator/{bot_number}")
+        url = self._url_typing
         data = {"recipient": self.get_recipients_from_event(event)[0]}
-        async with method(url, json=data) as resp:
-            await resp.json(content_type=None)
+        async with method(url, json=data, timeout=SEND_TIMEOUT) as resp:
+            if resp.status >= 400:
+                logger.warning("signal API %s: %s", resp.status, await resp.text())
+                return
+            # Drain the body so the connection goes back to the pool.
+            await resp.read()
 
     @register_event(opsdroid.events.Reaction)
     async def send_reaction(self, event):
         """Send a reaction to a message."""
-        logger.info("send reaction %s to %s", event, event.target)
+        logger.info("send reaction id=%s to %s", event.event_id, event.target)
         method = (self.session.post if event.emoji else self.session.delete)
-        url = self.make_url("/v1/reactions/{bot_number}")
+        url = self._url_reactions
         data = {
             "reaction": event.emoji,
             "recipient": self.get_recipients_from_event(event)[0],
             "target_author": event.linked_event.user_id,
             "timestamp": event.linked_event.event_id,
         }
-        async with method(url, json=data) as resp:
-            await resp.json(content_type=None)
+        async with method(url, json=data, timeout=SEND_TIMEOUT) as resp:
+            if resp.status >= 400:
+                logger.warning("signal API %s: %s", resp.status, await resp.text())
+                return
+            # Drain the body so the connection goes back to the pool.
+            await resp.read()
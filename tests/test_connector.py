@@ -0,0 +1,211 @@
+import asyncio
+import base64
+import importlib.util
+import json
+import pathlib
+import types
+
+import opsdroid.events
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+
+# The connector is the repository's top-level __init__.py, load it by path.
+_spec = importlib.util.spec_from_file_location(
+    "connector_signal", pathlib.Path(__file__).parent.parent / "__init__.py")
+connector_signal = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(connector_signal)
+
+
+class FakeRestApi:
+    """A minimal signal-cli-rest-api recording the requests it gets."""
+
+    def __init__(self):
+        self.mode = "normal"
+        self.packets = []
+        self.polls = []
+        self.poll_responses = []
+        self.sent = []
+        self.fetched = []
+        self.files = {}
+        self.app = web.Application()
+        self.app.router.add_get("/v1/about", self.about)
+        self.app.router.add_get("/v1/receive/{number}", self.receive)
+        self.app.router.add_post("/v2/send", self.send)
+        self.app.router.add_get("/files/{name}", self.file)
+
+    async def about(self, request):
+        return web.json_response({"mode": self.mode})
+
+    async def receive(self, request):
+        if request.headers.get("Upgrade", "").lower() != "websocket":
+            return await self.poll(request)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        for packet in self.packets:
+            await ws.send_json(packet)
+        async for msg in ws:
+            pass
+        return ws
+
+    async def poll(self, request):
+        self.polls.append(dict(request.query))
+        if not self.poll_responses:
+            await asyncio.sleep(0.05)
+            return web.json_response([])
+        response = self.poll_responses.pop(0)
+        if isinstance(response, int):
+            return web.Response(status=response, text="error")
+        return web.json_response(response)
+
+    async def send(self, request):
+        self.sent.append(json.loads(await request.read()))
+        return web.json_response({"timestamp": "1"}, status=201)
+
+    async def file(self, request):
+        name = request.match_info["name"]
+        self.fetched.append(name)
+        chunks = self.files.get(name, [b"from url"])
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        for chunk in chunks:
+            await resp.write(chunk)
+            await asyncio.sleep(0.01)
+        await resp.write_eof()
+        return resp
+
+
+def make_packet(timestamp, text):
+    return {"envelope": {"sourceNumber": "+200",
+                         "sourceName": "User",
+                         "timestamp": timestamp,
+                         "dataMessage": {"message": text}}}
+
+
+async def wait_until(condition):
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+def run(test, **config):
+    """Run test(api, connector) against a fake REST API."""
+    async def main():
+        api = FakeRestApi()
+        async with TestServer(api.app) as server:
+            config.update({"url": str(server.make_url("")), "bot-number": "+100"})
+            connector = connector_signal.ConnectorSignal(config)
+            await connector.connect()
+            try:
+                await test(api, connector)
+            finally:
+                await connector.disconnect()
+    asyncio.run(main())
+
+
+def test_pooled_connection_reuse():
+    async def test(api, connector):
+        for _ in range(2):
+            async with connector.session.get(connector._url_about) as resp:
+                await resp.read()
+        assert connector.connections_created == 1
+        assert connector.connections_reused == 1
+    run(test)
+
+
+def test_send_file_streams_url():
+    async def test(api, connector):
+        url = f"{connector._base}/files/a"
+        await connector.send_file(opsdroid.events.File(url=url, target="+200"))
+        assert api.fetched == ["a"]
+        assert api.sent[0]["recipients"] == ["+200"]
+        assert api.sent[0]["base64_attachments"] == [
+            base64.b64encode(b"from url").decode("ascii")]
+    run(test)
+
+
+def test_send_file_streams_url_in_chunks():
+    async def test(api, connector):
+        # None of these sizes, nor the client's 65536 byte reads, are
+        # multiples of 3, so base64 groups span chunk boundaries.
+        data = bytes(range(256)) * 800
+        api.files["big"] = [data[:70001], data[70001:135538], data[135538:]]
+        url = f"{connector._base}/files/big"
+        await connector.send_file(opsdroid.events.File(url=url, target="+200"))
+        assert api.sent[0]["base64_attachments"] == [
+            base64.b64encode(data).decode("ascii")]
+    run(test)
+
+
+def test_send_file_streams_external_url_through_proxy(monkeypatch):
+    async def test(api, connector):
+        # The fake API doubles as the proxy for an external host.
+        monkeypatch.setenv("HTTP_PROXY", connector._base)
+        monkeypatch.delenv("NO_PROXY", raising=False)
+        monkeypatch.delenv("no_proxy", raising=False)
+        event = opsdroid.events.File(url="http://files.invalid/files/b",
+                                     target="+200")
+        await connector.send_file(event)
+        assert api.fetched == ["b"]
+        assert api.sent[0]["base64_attachments"] == [
+            base64.b64encode(b"from url").decode("ascii")]
+    run(test)
+
+
+def test_send_file_uses_fetched_bytes():
+    async def test(api, connector):
+        url = f"{connector._base}/files/a"
+        event = opsdroid.events.File(url=url, target="+200")
+        event._file_bytes = b"cached"
+        await connector.send_file(event)
+        assert api.fetched == []
+        assert api.sent[0]["base64_attachments"] == [
+            base64.b64encode(b"cached").decode("ascii")]
+    run(test)
+
+
+def test_listen_websocket_parses_concurrently():
+    async def test(api, connector):
+        api.mode = "json-rpc"
+        api.packets = [make_packet(1, "first"), make_packet(2, "second")]
+        parsed = []
+        never = asyncio.Event()
+
+        async def parse(event):
+            parsed.append(event.text)
+            await never.wait()
+        connector.opsdroid = types.SimpleNamespace(parse=parse)
+
+        listen = asyncio.create_task(connector.listen())
+        # The second packet is parsed while the first is still blocked.
+        await wait_until(lambda: len(parsed) == 2)
+        assert parsed == ["first", "second"]
+
+        # Cancelling doesn't wait for the blocked skills.
+        listen.cancel()
+        done, _ = await asyncio.wait([listen], timeout=1)
+        assert listen in done and listen.cancelled()
+    run(test)
+
+
+def test_listen_polls_after_error():
+    async def test(api, connector):
+        api.poll_responses = [500, [make_packet(1, "hello")]]
+        parsed = []
+
+        async def parse(event):
+            parsed.append(event.text)
+        connector.opsdroid = types.SimpleNamespace(parse=parse)
+
+        listen = asyncio.create_task(connector.listen())
+        try:
+            await wait_until(lambda: parsed)
+        finally:
+            listen.cancel()
+            await asyncio.wait([listen])
+        assert parsed == ["hello"]
+        assert len(api.polls) >= 2
+        assert api.polls[0] == {"timeout": "5", "max_messages": "10"}
+    run(test, **{"poll-interval": 0.01})